@@ -29,6 +29,7 @@ from .const import (
     ATTR_PRESENCE,
     ATTR_PRESSURE,
     ATTR_PUSHED,
+    ATTR_RELEASED,
     ATTR_SECURITY_KEYPAD,
     ATTR_SMOKE,
     ATTR_SPEED,
@@ -169,6 +170,7 @@ __all__ = [
     "ATTR_PRESENCE",
     "ATTR_PRESSURE",
     "ATTR_PUSHED",
+    "ATTR_RELEASED",
     "ATTR_SECURITY_KEYPAD",
     "ATTR_SMOKE",
     "ATTR_SPEED",
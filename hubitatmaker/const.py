@@ -57,6 +57,7 @@ ATTR_PRESENCE = "presence"
 ATTR_PRESSURE = "pressure"
 ATTR_POWER_SOURCE = "powerSource"
 ATTR_PUSHED = "pushed"
+ATTR_RELEASED = "released"
 ATTR_SECURITY_KEYPAD = "securityKeypad"
 ATTR_SMOKE = "smoke"
 ATTR_TEMPERATURE = "temperature"
@@ -1,25 +1,75 @@
 """Hubitat API."""
+import asyncio
 from contextlib import contextmanager
-from logging import getLogger
+from logging import DEBUG, getLogger
 import re
 import socket
+import sys
 from types import MappingProxyType
-from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Union
+from typing import (
+    Any,
+    Callable,
+    Coroutine,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+    Union,
+)
 from urllib.parse import ParseResult, quote, urlparse
 
 import aiohttp
 import getmac
 
 from . import server
-from .const import ID_HSM_STATUS, ID_MODE
+from .const import (
+    ATTR_DOUBLE_TAPPED,
+    ATTR_HELD,
+    ATTR_PUSHED,
+    ATTR_RELEASED,
+    ID_HSM_STATUS,
+    ID_MODE,
+)
 from .error import InvalidConfig, InvalidMode, InvalidToken, RequestError
 from .types import Device, Event, Mode
 
+try:
+    import ijson
+except ImportError:
+    ijson = None  # type: ignore
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
 Listener = Callable[[Event], None]
 
 
 _LOGGER = getLogger(__name__)
 
+# Connection pool settings for the shared HTTP session
+_CONNECTION_LIMIT = 10
+_KEEPALIVE_TIMEOUT = 30
+_SESSION_TIMEOUT = 30
+# Hub addresses rarely change, so resolve the hub's host name infrequently
+_DNS_CACHE_TTL = 600
+
+# Per-request timeout and retry settings
+_REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=15, connect=5)
+_REQUEST_ATTEMPTS = 3
+_RETRY_DELAY = 0.2
+
+# Attributes whose events are meaningful even when the value doesn't change
+# (e.g., a button pushed twice in a row)
+_MOMENTARY_ATTRS = frozenset(
+    (ATTR_DOUBLE_TAPPED, ATTR_HELD, ATTR_PUSHED, ATTR_RELEASED)
+)
+
+_IPV4_RE = re.compile(r"\d+\.\d+\.\d+\.\d+")
+
 
 class Hub:
     """A representation of a Hubitat hub.
@@ -28,6 +78,31 @@ class Hub:
     the hub to push it state updates for devices.
     """
 
+    __slots__ = (
+        "api_url",
+        "app_id",
+        "base_url",
+        "event_url",
+        "host",
+        "mac",
+        "max_concurrent_requests",
+        "port",
+        "scheme",
+        "token",
+        "_device_ids",
+        "_devices",
+        "_close_task",
+        "_hsm_status",
+        "_last_event_url",
+        "_listeners",
+        "_modes",
+        "_repr",
+        "_server",
+        "_session",
+        "_token_qs",
+        "__weakref__",
+    )
+
     api_url: str
     app_id: str
     host: str
@@ -35,7 +110,7 @@ class Hub:
     token: str
     mac: str
 
-    _server: server.Server
+    _server: Optional[server.Server]
 
     def __init__(
         self,
@@ -44,6 +119,7 @@ class Hub:
         access_token: str,
         port: int = None,
         event_url: str = None,
+        max_concurrent_requests: int = 5,
     ):
         """Initialize a Hubitat hub interface.
 
@@ -59,6 +135,9 @@ class Hub:
           The port to listen on for events (optional). Defaults to a random open port.
         event_url:
           The URL that Hubitat should send events to (optional). Defaults the server's actual address and port.
+        max_concurrent_requests:
+          The maximum number of device requests that will be made to the hub
+          at once when loading devices (optional). Defaults to 5.
         """
         if not host or not app_id or not access_token:
             raise InvalidConfig()
@@ -67,12 +146,19 @@ class Hub:
         self.port = _get_event_port(port, event_url)
         self.app_id = app_id
         self.token = access_token
+        self._token_qs = f"?access_token={quote(access_token, safe='')}"
         self.mac = ""
+        self._last_event_url: Optional[str] = None
+        self.max_concurrent_requests = max_concurrent_requests
 
         self.set_host(host)
 
+        self._server = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._close_task: Optional["asyncio.Future[None]"] = None
         self._devices: Dict[str, Device] = {}
-        self._listeners: Dict[str, List[Listener]] = {}
+        self._device_ids: Optional[List[str]] = None
+        self._listeners: Dict[str, Tuple[Listener, ...]] = {}
         self._modes: List[Mode] = []
         self._hsm_status: str = "disarmed"
 
@@ -80,7 +166,7 @@ class Hub:
 
     def __repr__(self) -> str:
         """Return a string representation of this hub."""
-        return f"<Hub host={self.host} app_id={self.app_id}>"
+        return self._repr
 
     @property
     def devices(self) -> Mapping[str, Device]:
@@ -106,33 +192,27 @@ class Hub:
 
     def add_device_listener(self, device_id: str, listener: Listener) -> None:
         """Listen for updates for a particular device."""
-        if device_id not in self._listeners:
-            self._listeners[device_id] = []
-        self._listeners[device_id].append(listener)
+        self._add_listener(device_id, listener)
 
     def add_mode_listener(self, listener: Listener) -> None:
         """Listen for updates for the hub mode."""
-        if ID_MODE not in self._listeners:
-            self._listeners[ID_MODE] = []
-        self._listeners[ID_MODE].append(listener)
+        self._add_listener(ID_MODE, listener)
 
     def add_hsm_listener(self, listener: Listener) -> None:
         """Listen for updates for the hub HSM status."""
-        if ID_HSM_STATUS not in self._listeners:
-            self._listeners[ID_HSM_STATUS] = []
-        self._listeners[ID_HSM_STATUS].append(listener)
+        self._add_listener(ID_HSM_STATUS, listener)
 
     def remove_device_listeners(self, device_id: str) -> None:
         """Remove all listeners for a particular device."""
-        self._listeners[device_id] = []
+        self._listeners[device_id] = ()
 
     def remove_mode_listeners(self) -> None:
         """Remove all listeners for mode changes."""
-        self._listeners[ID_MODE] = []
+        self._listeners[ID_MODE] = ()
 
     def remove_hsm_status_listeners(self) -> None:
         """Remove all listeners for HSM status changes."""
-        self._listeners[ID_HSM_STATUS] = []
+        self._listeners[ID_HSM_STATUS] = ()
 
     async def check_config(self) -> None:
         """Verify that the hub is accessible.
@@ -148,12 +228,26 @@ class Hub:
     async def load_devices(self, force_refresh=False) -> None:
         """Load the current state of all devices."""
         if force_refresh or len(self._devices) == 0:
-            devices: List[Dict[str, Any]] = await self._api_request("devices")
-            _LOGGER.debug("Loaded device list")
-
-            # load devices sequentially to avoid overloading the hub
-            for dev in devices:
-                await self._load_device(dev["id"], force_refresh)
+            # Reuse the device list fetched by check_config, if there is one
+            device_ids = self._device_ids
+            self._device_ids = None
+            if force_refresh or device_ids is None:
+                device_ids = await self._load_device_ids()
+                _LOGGER.debug("Loaded device list")
+
+            # only schedule loads for devices that actually need loading
+            if not force_refresh:
+                device_ids = [id for id in device_ids if id not in self._devices]
+
+            # load devices concurrently, but limit the number of in-flight
+            # requests to avoid overloading the hub
+            sem = asyncio.Semaphore(self.max_concurrent_requests)
+            await _run_concurrently(
+                *[
+                    self._bounded_load_device(sem, device_id, force_refresh)
+                    for device_id in device_ids
+                ]
+            )
 
     async def start(self) -> None:
         """Download initial state data, and start an event server if requested.
@@ -163,29 +257,45 @@ class Hub:
         before this method has completed.
         """
         try:
-            await self._start_server()
-            await self.load_devices()
+            await _run_concurrently(self._start_server(), self.load_devices())
             _LOGGER.debug("Connected to Hubitat hub at %s", self.host)
-        except aiohttp.ClientError as e:
-            raise ConnectionError(str(e))
+        except Exception as e:
+            # Don't leave the HTTP session open if the hub couldn't be started
+            await self._close_session()
+            if isinstance(e, aiohttp.ClientError):
+                raise ConnectionError(str(e))
+            raise
 
         try:
             await self._load_modes()
         except (aiohttp.ClientError, RequestError) as e:
-            _LOGGER.warning(f"Unable to access modes: {e}")
+            _LOGGER.warning("Unable to access modes: %s", e)
 
         try:
             await self._load_hsm_status()
         except (aiohttp.ClientError, RequestError) as e:
-            _LOGGER.warning(f"Unable to access HSM status: {e}")
+            _LOGGER.warning("Unable to access HSM status: %s", e)
 
     def stop(self) -> None:
-        """Remove all listeners and stop the event server (if running)."""
+        """Remove all listeners, stop the event server (if running), and close
+        the HTTP session."""
         if self._server:
             self._server.stop()
             _LOGGER.info("Stopped event server")
         self._listeners = {}
 
+        if self._session:
+            session = self._session
+            self._session = None
+            loop = asyncio.get_event_loop()
+            if loop.is_running():
+                # The loop only holds weak references to tasks, so keep one
+                # until the session has finished closing
+                self._close_task = loop.create_task(session.close())
+                self._close_task.add_done_callback(self._clear_close_task)
+            else:
+                loop.run_until_complete(session.close())
+
     async def refresh_device(self, device_id: str) -> None:
         """Refresh a device's state."""
         await self._load_device(device_id, force_refresh=True)
@@ -198,15 +308,23 @@ class Hub:
         if arg:
             path += f"/{arg}"
         _LOGGER.debug("Sending command %s(%s) to %s", command, arg, device_id)
-        return await self._api_request(path)
+        # Commands aren't necessarily idempotent (e.g., toggle), so only
+        # retry them if the hub couldn't be reached at all
+        return await self._api_request(path, retry=False)
 
     async def set_event_url(self, event_url: Optional[str]) -> None:
         """Set the URL that Hubitat will POST device events to."""
         if not event_url:
+            assert self._server, "Event server hasn't been started"
             event_url = self._server.url
-        url = quote(str(event_url), safe="")
+        event_url = str(event_url)
+        if event_url == self._last_event_url:
+            _LOGGER.debug("Event update URL is already %s", event_url)
+            return
+        url = quote(event_url, safe="")
         _LOGGER.info("Setting event update URL to %s", url)
         await self._api_request(f"postURL/{url}")
+        self._last_event_url = event_url
 
     async def set_hsm(self, hsm_mode: str) -> None:
         """Update the hub's HSM status.
@@ -238,6 +356,9 @@ class Hub:
         self.host = host_url.netloc or host_url.path
         self.base_url = f"{self.scheme}://{self.host}"
         self.api_url = f"{self.base_url}/apps/api/{self.app_id}"
+        self._repr = f"<Hub host={self.host} app_id={self.app_id}>"
+        # A different hub won't know about any previously set event URL
+        self._last_event_url = None
         self.mac = _get_mac_address(self.host) or ""
 
     async def set_port(self, port: int) -> None:
@@ -250,30 +371,51 @@ class Hub:
             self._server.stop()
         await self._start_server()
 
+    def _clear_close_task(self, task: "asyncio.Future[None]") -> None:
+        """Release a finished session close task."""
+        if self._close_task is task:
+            self._close_task = None
+
+    def _add_listener(self, listener_id: str, listener: Listener) -> None:
+        """Add a listener for a device or hub ID.
+
+        Listener collections are stored as immutable tuples that are replaced
+        on every change, so event processing can iterate over them directly.
+        """
+        self._listeners[listener_id] = self._listeners.get(listener_id, ()) + (
+            listener,
+        )
+
     async def _check_api(self) -> None:
         """Check for api access.
 
-        An error will be raised if a test API request fails.
+        An error will be raised if a test API request fails. The device list
+        is kept so that a subsequent call to load_devices doesn't need to
+        request it again.
         """
-        await self._api_request("devices")
+        self._device_ids = await self._load_device_ids()
 
     def _process_event(self, event: Dict[str, Any]) -> None:
         """Process an event received from the hub."""
         try:
             content = event["content"]
-            _LOGGER.debug("Received event: %s", content)
+            if _LOGGER.isEnabledFor(DEBUG):
+                _LOGGER.debug("Received event: %s", content)
         except KeyError:
             _LOGGER.warning("Received invalid event: %s", event)
             return
 
         if content["deviceId"] is not None:
             device_id = content["deviceId"]
-            self._update_device_attr(device_id, content["name"], content["value"])
-
-            evt = Event(content)
-
-            if device_id in self._listeners:
-                for listener in self._listeners[device_id]:
+            name = sys.intern(content["name"])
+            changed = self._update_device_attr(device_id, name, content["value"])
+            if not changed and name not in _MOMENTARY_ATTRS:
+                return
+
+            listeners = self._listeners.get(device_id)
+            if listeners:
+                evt = Event(content)
+                for listener in listeners:
                     listener(evt)
         elif content["name"] == "mode":
             name = content["value"]
@@ -291,35 +433,56 @@ class Hub:
                 self._modes.append(Mode({"active": True, "name": name}))
                 _ = self._load_modes()
 
-            evt = Event(content)
-
-            for listener in self._listeners.get(ID_MODE, []):
-                listener(evt)
+            listeners = self._listeners.get(ID_MODE)
+            if listeners:
+                evt = Event(content)
+                for listener in listeners:
+                    listener(evt)
 
         elif content["name"] == "hsmStatus":
             self._hsm_status = content["value"]
-            evt = Event(content)
-            for listener in self._listeners.get(ID_HSM_STATUS, []):
-                listener(evt)
+            listeners = self._listeners.get(ID_HSM_STATUS)
+            if listeners:
+                evt = Event(content)
+                for listener in listeners:
+                    listener(evt)
 
     def _update_device_attr(
         self, device_id: str, attr_name: str, value: Union[int, str]
-    ) -> None:
-        """Update a device attribute value."""
-        _LOGGER.debug("Updating %s of %s to %s", attr_name, device_id, value)
+    ) -> bool:
+        """Update a device attribute value.
+
+        Return False if the attribute already had the given value, True
+        otherwise.
+        """
+        if _LOGGER.isEnabledFor(DEBUG):
+            _LOGGER.debug("Updating %s of %s to %s", attr_name, device_id, value)
         try:
             dev = self._devices[device_id]
         except KeyError:
             _LOGGER.warning("Tried to update unknown device %s", device_id)
-            return
+            return True
 
         try:
             attr = dev.attributes[attr_name]
         except KeyError:
             _LOGGER.warning("Tried to update unknown attribute %s", attr_name)
-            return
+            return True
+
+        # Device details may report numeric values (e.g., 100) while events
+        # always report strings (e.g., "100"), so compare string forms
+        if str(attr.value) == str(value):
+            return False
 
         attr.update_value(value)
+        return True
+
+    async def _bounded_load_device(
+        self, sem: asyncio.Semaphore, device_id: str, force_refresh=False
+    ) -> None:
+        """Load a device once a slot is available in the given semaphore."""
+        async with sem:
+            await self._load_device(device_id, force_refresh)
 
     async def _load_device(self, device_id: str, force_refresh=False) -> None:
         """Return full info for a specific device."""
@@ -336,6 +499,10 @@ class Hub:
                 raise e
             _LOGGER.debug("Loaded device %s", device_id)
 
+    async def _load_device_ids(self) -> List[str]:
+        """Return the IDs of all devices available through the Maker API."""
+        return await self._api_request("devices", ids_only=True)
+
     async def _load_hsm_status(self) -> None:
         """Load the current hub HSM status."""
         hsm: Dict[str, str] = await self._api_request("hsm")
@@ -351,25 +518,97 @@ class Hub:
         except Exception as e:
             _LOGGER.error("Error loading modes: %s", e)
 
-    async def _api_request(self, path: str, method="GET") -> Any:
-        """Make a Maker API request."""
-        params = {"access_token": self.token}
-        conn = aiohttp.TCPConnector(ssl=False)
-        try:
-            async with aiohttp.request(
-                method, f"{self.api_url}/{path}", params=params, connector=conn
-            ) as resp:
-                if resp.status >= 400:
-                    if resp.status == 401:
-                        raise InvalidToken()
+    async def _api_request(
+        self,
+        path: str,
+        method="GET",
+        retry=True,
+        ids_only=False,
+    ) -> Any:
+        """Make a Maker API request.
+
+        Requests that fail to connect are retried with an exponential backoff.
+        If retry is True, requests that time out or that fail with a server
+        error are also retried; it should be False for requests that aren't
+        safe to repeat.
+
+        If ids_only is True, the response must be a JSON array, and a list of
+        the id of each item is returned. If ijson is installed, the IDs are
+        parsed from the response as it streams in rather than decoding the
+        entire response first.
+        """
+        session = self._get_session()
+        url = f"{self.api_url}/{path}{self._token_qs}"
+
+        for attempt in range(_REQUEST_ATTEMPTS):
+            if attempt > 0:
+                await asyncio.sleep(_RETRY_DELAY * 2 ** (attempt - 1))
+            last_attempt = attempt == _REQUEST_ATTEMPTS - 1
+
+            try:
+                async with session.request(
+                    method, url, timeout=_REQUEST_TIMEOUT
+                ) as resp:
+                    if resp.status >= 500 and retry and not last_attempt:
+                        _LOGGER.debug("Retrying %s after [%d]", path, resp.status)
+                        continue
+                    if resp.status >= 400:
+                        if resp.status == 401:
+                            raise InvalidToken()
+                        else:
+                            raise RequestError(resp)
+                    # Leave non-JSON responses to resp.json(), which raises a
+                    # ContentTypeError for them
+                    is_json = resp.content_type == "application/json"
+                    if ids_only and ijson and is_json:
+                        return await _stream_ids(resp)
+                    if orjson and is_json:
+                        json = orjson.loads(await resp.read())
                     else:
+                        json = await resp.json()
+                    if "error" in json and json["error"]:
                         raise RequestError(resp)
-                json = await resp.json()
-                if "error" in json and json["error"]:
-                    raise RequestError(resp)
-                return json
-        finally:
-            await conn.close()
+                    if ids_only:
+                        if not isinstance(json, list):
+                            raise RequestError(resp)
+                        return [item["id"] for item in json]
+                    return json
+            except aiohttp.ClientConnectorError as e:
+                if last_attempt:
+                    raise
+                _LOGGER.debug("Retrying %s after connection error: %s", path, e)
+            except asyncio.TimeoutError:
+                if last_attempt or not retry:
+                    raise
+                _LOGGER.debug("Retrying %s after timeout", path)
+
+    async def _close_session(self) -> None:
+        """Close the HTTP session, if one is open."""
+        if self._session:
+            session = self._session
+            self._session = None
+            await session.close()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Return the HTTP session used for hub requests, creating it if
+        necessary.
+
+        A single session is shared by all requests so that connections to the
+        hub are pooled and kept alive rather than being reopened for every
+        request.
+        """
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    ssl=False,
+                    limit=_CONNECTION_LIMIT,
+                    limit_per_host=self.max_concurrent_requests,
+                    keepalive_timeout=_KEEPALIVE_TIMEOUT,
+                    ttl_dns_cache=_DNS_CACHE_TTL,
+                ),
+                timeout=aiohttp.ClientTimeout(total=_SESSION_TIMEOUT),
+            )
+        return self._session
 
     async def _start_server(self) -> None:
         """Start an event listener server."""
@@ -389,6 +628,42 @@ class Hub:
         await self.set_event_url(self.event_url)
 
 
+async def _stream_ids(resp: aiohttp.ClientResponse) -> List[Any]:
+    """Stream-parse the id of each item in a JSON array response.
+
+    A RequestError is raised if the response isn't an array, such as a Maker
+    API error object.
+    """
+    ids: List[Any] = []
+    async for prefix, event, value in ijson.parse_async(resp.content):
+        if prefix == "":
+            if event == "start_array":
+                continue
+            if event == "end_array":
+                break
+            raise RequestError(resp)
+        if prefix == "item.id":
+            ids.append(value)
+    return ids
+
+
+async def _run_concurrently(*coros: Coroutine[Any, Any, Any]) -> None:
+    """Run coroutines concurrently, raising the first error encountered.
+
+    On Python 3.11+ this uses a TaskGroup, which cancels the remaining
+    coroutines when one fails; otherwise it falls back to asyncio.gather.
+    """
+    if sys.version_info >= (3, 11):
+        try:
+            async with asyncio.TaskGroup() as tg:
+                for coro in coros:
+                    tg.create_task(coro)
+        except BaseExceptionGroup as e:
+            raise e.exceptions[0] from None
+    else:
+        await asyncio.gather(*coros)
+
+
 @contextmanager
 def _open_socket(*args: Any, **kwargs: Any) -> Iterator[socket.socket]:
     """Open a socket as a context manager."""
@@ -428,6 +703,6 @@ def _get_event_url(port: Optional[int], event_url: Optional[str]) -> Optional[st
 
 def _get_mac_address(host: str) -> Optional[str]:
     """Return the mac address of a remote host."""
-    if re.match("\\d+\\.\\d+\\.\\d+\\.\\d+", host):
+    if _IPV4_RE.match(host):
         return getmac.get_mac_address(ip=host)
     return getmac.get_mac_address(hostname=host)
@@ -1,7 +1,8 @@
 import asyncio
+from collections import deque
 from socket import socket as Socket
 import threading
-from typing import Any, Callable, Dict, List, Optional, cast
+from typing import Any, Callable, Deque, Dict, List, Optional, cast
 
 from aiohttp import web
 
@@ -17,6 +18,9 @@ class Server:
         self.port = port
         self.handle_event = handle_event
         self._main_loop = asyncio.get_event_loop()
+        self._pending_events: Deque[Dict[str, Any]] = deque()
+        self._pending_lock = threading.Lock()
+        self._flush_scheduled = False
 
     @property
     def url(self) -> str:
@@ -49,11 +53,38 @@ class Server:
     async def _handle_request(self, request: web.Request) -> web.Response:
         """Handle an incoming request."""
         event = await request.json()
-        # This handler will be called on the server thread. Call the external
-        # handler on the app thread.
-        self._main_loop.call_soon_threadsafe(self.handle_event, event)
+        # This handler will be called on the server thread. Queue the event
+        # and, if a flush isn't already pending, schedule one on the app
+        # thread. A burst of events is then delivered in a single app thread
+        # callback rather than waking the app loop once per event.
+        with self._pending_lock:
+            self._pending_events.append(event)
+            schedule_flush = not self._flush_scheduled
+            self._flush_scheduled = True
+        if schedule_flush:
+            self._main_loop.call_soon_threadsafe(self._flush_events)
         return web.Response(text="OK")
 
+    def _flush_events(self) -> None:
+        """Deliver all queued events to the external handler, in order."""
+        with self._pending_lock:
+            events = list(self._pending_events)
+            self._pending_events.clear()
+            self._flush_scheduled = False
+        for event in events:
+            # Each event was previously delivered in its own callback, so a
+            # failure to handle one event mustn't affect the rest of the batch
+            try:
+                self.handle_event(event)
+            except Exception as e:
+                self._main_loop.call_exception_handler(
+                    {
+                        "message": "Error handling event",
+                        "exception": e,
+                        "event": event,
+                    }
+                )
+
     def _run(self) -> None:
         """Execute the server in its own thread with its own event loop."""
         asyncio.set_event_loop(self._server_loop)
@@ -2,13 +2,20 @@ import asyncio
 import json
 from os.path import dirname, join
 import re
+import sys
 from typing import Any, Coroutine, Dict, List, Optional, Union
 from unittest import TestCase
 from unittest.mock import patch
 from urllib.parse import unquote
+import weakref
+
+import aiohttp
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
 
 from hubitatmaker.const import HSM_DISARM
-from hubitatmaker.hub import Hub, InvalidConfig
+from hubitatmaker.error import RequestError
+from hubitatmaker.hub import Hub, InvalidConfig, InvalidToken
 
 hub_edit_page: str
 devices: Dict[str, Any]
@@ -49,6 +56,18 @@ def wait_for(cr: Coroutine) -> Any:
     return asyncio.get_event_loop().run_until_complete(cr)
 
 
+class FakeStream:
+    def __init__(self, data: bytes):
+        self._data = data
+
+    async def read(self, n: int = -1) -> bytes:
+        if n < 0:
+            n = len(self._data)
+        chunk = self._data[:n]
+        self._data = self._data[n:]
+        return chunk
+
+
 class FakeResponse:
     def __init__(
         self,
@@ -57,18 +76,34 @@ class FakeResponse:
         method: str = "GET",
         url: str = "/",
         reason: str = "",
+        content_type: str = "application/json",
     ):
         self.status = status
         self._data = data
         self.method = method
         self.url = url
         self.reason = reason
+        self.content_type = content_type
 
     async def json(self):
+        if self.content_type != "application/json":
+            request_info = aiohttp.RequestInfo(
+                URL(self.url), self.method, CIMultiDictProxy(CIMultiDict())
+            )
+            raise aiohttp.ContentTypeError(request_info, (), message=self.content_type)
         if isinstance(self._data, str):
             return json.loads(self._data)
         return self._data
 
+    async def read(self):
+        return (await self.text()).encode()
+
+    @property
+    def content(self):
+        if isinstance(self._data, str):
+            return FakeStream(self._data.encode())
+        return FakeStream(json.dumps(self._data).encode())
+
     async def text(self):
         if isinstance(self._data, str):
             return self._data
@@ -85,6 +120,7 @@ requests: List[Dict[str, Any]] = []
 def create_fake_request(responses: Optional[Dict] = {}):
     class fake_request:
         def __init__(self, method: str, url: str, **kwargs: Any):
+            url, _, query = url.partition("?")
             if url.endswith("/hub/edit"):
                 if "/hub/edit" in responses:
                     self.response = responses["/hub/edit"]
@@ -136,7 +172,9 @@ def create_fake_request(responses: Optional[Dict] = {}):
             else:
                 self.response = FakeResponse(data="{}", url=url)
 
-            requests.append({"method": method, "url": url, "data": kwargs})
+            requests.append(
+                {"method": method, "url": url, "query": query, "data": kwargs}
+            )
 
         async def __aenter__(self):
             return self.response
@@ -147,6 +185,22 @@ def create_fake_request(responses: Optional[Dict] = {}):
     return fake_request
 
 
+def create_fake_session(responses: Optional[Dict] = {}):
+    fake_request = create_fake_request(responses)
+
+    class fake_session:
+        def __init__(self, **kwargs: Any):
+            self.closed = False
+
+        def request(self, method: str, url: str, **kwargs: Any):
+            return fake_request(method, url, **kwargs)
+
+        async def close(self):
+            self.closed = True
+
+    return fake_session
+
+
 def fake_get_mac_address(**kwargs: str):
     return "aa:bb:cc:dd:ee:ff"
 
@@ -170,9 +224,16 @@ class TestHub(TestCase):
         """Hub properties should have expected initial values."""
         hub = Hub("1.2.3.4", "1234", "token")
         self.assertEqual(list(hub.devices), [])
+        self.assertEqual(repr(hub), "<Hub host=1.2.3.4 app_id=1234>")
+
+        hub.set_host("http://1.2.3.5")
+        self.assertEqual(repr(hub), "<Hub host=1.2.3.5 app_id=1234>")
+
+        # Hubs should still support weak references
+        self.assertIs(weakref.ref(hub)(), hub)
 
     @patch("getmac.get_mac_address", new=fake_get_mac_address)
-    @patch("aiohttp.request", new=create_fake_request())
+    @patch("aiohttp.ClientSession", new=create_fake_session())
     @patch("hubitatmaker.server.Server")
     def test_start_server(self, MockServer) -> None:
         """Hub should start a server when asked to."""
@@ -181,7 +242,7 @@ class TestHub(TestCase):
         self.assertTrue(MockServer.called)
 
     @patch("getmac.get_mac_address", new=fake_get_mac_address)
-    @patch("aiohttp.request", new=create_fake_request())
+    @patch("aiohttp.ClientSession", new=create_fake_session())
     @patch("hubitatmaker.server.Server")
     def test_start(self, MockServer) -> None:
         """start() should request data from the Hubitat hub."""
@@ -199,11 +260,25 @@ class TestHub(TestCase):
         self.assertRegex(requests[3]["url"], r"devices/\d+$")
         self.assertRegex(requests[-2]["url"], "modes$")
         self.assertRegex(requests[-1]["url"], "hsm$")
+        for r in requests:
+            self.assertEqual(r["query"], "access_token=token")
+
+    @patch("getmac.get_mac_address", new=fake_get_mac_address)
+    @patch("aiohttp.ClientSession", new=create_fake_session())
+    @patch("hubitatmaker.server.Server")
+    def test_start_after_check_config(self, MockServer) -> None:
+        """start() should reuse the device list loaded by check_config()."""
+        hub = Hub("1.2.3.4", "1234", "token")
+        wait_for(hub.check_config())
+        wait_for(hub.start())
+        device_list_requests = [r for r in requests if r["url"].endswith("/devices")]
+        self.assertEqual(len(device_list_requests), 1)
+        self.assertEqual(len(hub.devices), 9)
 
     @patch("getmac.get_mac_address", new=fake_get_mac_address)
     @patch(
-        "aiohttp.request",
-        new=create_fake_request({"/hsm": FakeResponse(400, url="/hsm")}),
+        "aiohttp.ClientSession",
+        new=create_fake_session({"/hsm": FakeResponse(400, url="/hsm")}),
     )
     @patch("hubitatmaker.server.Server")
     def test_start_no_hsm(self, MockServer) -> None:
@@ -217,7 +292,44 @@ class TestHub(TestCase):
         self.assertRegex(requests[-1]["url"], "hsm$")
 
     @patch("getmac.get_mac_address", new=fake_get_mac_address)
-    @patch("aiohttp.request", new=create_fake_request())
+    @patch(
+        "aiohttp.ClientSession",
+        new=create_fake_session({"/devices": FakeResponse(401, url="/devices")}),
+    )
+    @patch("hubitatmaker.server.Server")
+    def test_start_invalid_token(self, MockServer) -> None:
+        """start() should raise errors from concurrent startup tasks directly."""
+        hub = Hub("1.2.3.4", "1234", "token")
+        with self.assertRaises(InvalidToken) as ctx:
+            wait_for(hub.start())
+        if sys.version_info >= (3, 11):
+            # The TaskGroup's ExceptionGroup shouldn't show up in tracebacks
+            self.assertTrue(ctx.exception.__suppress_context__)
+        self.assertIsNone(hub._session)
+
+    @patch("getmac.get_mac_address", new=fake_get_mac_address)
+    @patch(
+        "aiohttp.ClientSession",
+        new=create_fake_session({"/hsm": FakeResponse(503, url="/hsm")}),
+    )
+    @patch("hubitatmaker.server.Server")
+    def test_start_hsm_server_error(self, MockServer) -> None:
+        """Requests that fail with a server error should be retried."""
+        delays: List[float] = []
+
+        async def fake_sleep(delay: float) -> None:
+            delays.append(delay)
+
+        hub = Hub("1.2.3.4", "1234", "token")
+        with patch("asyncio.sleep", new=fake_sleep):
+            wait_for(hub.start())
+        hsm_requests = [r for r in requests if r["url"].endswith("/hsm")]
+        self.assertEqual(len(hsm_requests), 3)
+        self.assertEqual(len(delays), 2)
+        self.assertLess(delays[0], delays[1])
+
+    @patch("getmac.get_mac_address", new=fake_get_mac_address)
+    @patch("aiohttp.ClientSession", new=create_fake_session())
     @patch("hubitatmaker.server.Server")
     def test_default_event_url(self, MockServer) -> None:
         """Default event URL should be server URL."""
@@ -228,7 +340,7 @@ class TestHub(TestCase):
         self.assertRegex(url, r"http://127.0.0.1:81$")
 
     @patch("getmac.get_mac_address", new=fake_get_mac_address)
-    @patch("aiohttp.request", new=create_fake_request())
+    @patch("aiohttp.ClientSession", new=create_fake_session())
     @patch("hubitatmaker.server.Server")
     def test_custom_event_url(self, MockServer) -> None:
         """Event URL should be configurable."""
@@ -239,7 +351,7 @@ class TestHub(TestCase):
         self.assertRegex(url, r"http://foo\.local$")
 
     @patch("getmac.get_mac_address", new=fake_get_mac_address)
-    @patch("aiohttp.request", new=create_fake_request())
+    @patch("aiohttp.ClientSession", new=create_fake_session())
     @patch("hubitatmaker.server.Server")
     def test_custom_event_url_without_port(self, MockServer) -> None:
         """Event URL should use custom port if none was provided."""
@@ -250,7 +362,7 @@ class TestHub(TestCase):
         self.assertRegex(url, r"http://foo\.local:420$")
 
     @patch("getmac.get_mac_address", new=fake_get_mac_address)
-    @patch("aiohttp.request", new=create_fake_request())
+    @patch("aiohttp.ClientSession", new=create_fake_session())
     @patch("hubitatmaker.server.Server")
     def test_custom_event_port(self, MockServer) -> None:
         """Event server port should be configurable."""
@@ -260,7 +372,7 @@ class TestHub(TestCase):
         self.assertEqual(MockServer.call_args[0][2], 420)
 
     @patch("getmac.get_mac_address", new=fake_get_mac_address)
-    @patch("aiohttp.request", new=create_fake_request())
+    @patch("aiohttp.ClientSession", new=create_fake_session())
     @patch("hubitatmaker.server.Server")
     def test_custom_event_port_from_url(self, MockServer) -> None:
         """Event server port should come from event URL if none was provided."""
@@ -270,7 +382,7 @@ class TestHub(TestCase):
         self.assertEqual(MockServer.call_args[0][2], 416)
 
     @patch("getmac.get_mac_address", new=fake_get_mac_address)
-    @patch("aiohttp.request", new=create_fake_request())
+    @patch("aiohttp.ClientSession", new=create_fake_session())
     @patch("hubitatmaker.server.Server")
     def test_custom_event_port_and_url(self, MockServer) -> None:
         """Explicit event server port should override port from URL."""
@@ -280,7 +392,7 @@ class TestHub(TestCase):
         self.assertEqual(MockServer.call_args[0][2], 420)
 
     @patch("getmac.get_mac_address", new=fake_get_mac_address)
-    @patch("aiohttp.request", new=create_fake_request())
+    @patch("aiohttp.ClientSession", new=create_fake_session())
     @patch("hubitatmaker.server.Server")
     def test_stop_server(self, MockServer) -> None:
         """Hub should stop a server when stopped."""
@@ -291,7 +403,51 @@ class TestHub(TestCase):
         self.assertTrue(MockServer.return_value.stop.called)
 
     @patch("getmac.get_mac_address", new=fake_get_mac_address)
-    @patch("aiohttp.request", new=create_fake_request())
+    @patch("aiohttp.ClientSession", new=create_fake_session())
+    @patch("hubitatmaker.server.Server")
+    def test_session_reused(self, MockServer) -> None:
+        """Hub should reuse one HTTP session and close it when stopped."""
+        hub = Hub("1.2.3.4", "1234", "token")
+        wait_for(hub.start())
+        session = hub._session
+        self.assertIsNotNone(session)
+        wait_for(hub.refresh_device("176"))
+        self.assertIs(hub._session, session)
+        hub.stop()
+        self.assertTrue(session.closed)
+        self.assertIsNone(hub._session)
+
+    @patch("getmac.get_mac_address", new=fake_get_mac_address)
+    @patch("aiohttp.ClientSession", new=create_fake_session())
+    def test_stop_after_check_config(self) -> None:
+        """Hub should close its session when stopped without being started."""
+        hub = Hub("1.2.3.4", "1234", "token")
+        wait_for(hub.check_config())
+        session = hub._session
+        hub.stop()
+        self.assertTrue(session.closed)
+        self.assertIsNone(hub._session)
+
+    @patch("getmac.get_mac_address", new=fake_get_mac_address)
+    @patch("aiohttp.ClientSession", new=create_fake_session())
+    @patch("hubitatmaker.server.Server")
+    def test_stop_in_running_loop(self, MockServer) -> None:
+        """Hub should close its session when stopped from a running loop."""
+        hub = Hub("1.2.3.4", "1234", "token")
+        wait_for(hub.start())
+        session = hub._session
+
+        async def stop():
+            hub.stop()
+            self.assertIsNotNone(hub._close_task)
+            await asyncio.sleep(0)
+
+        wait_for(stop())
+        self.assertTrue(session.closed)
+        self.assertIsNone(hub._close_task)
+
+    @patch("getmac.get_mac_address", new=fake_get_mac_address)
+    @patch("aiohttp.ClientSession", new=create_fake_session())
     @patch("hubitatmaker.server.Server")
     def test_devices_loaded(self, MockServer) -> None:
         """Started hub should have parsed device info."""
@@ -300,7 +456,106 @@ class TestHub(TestCase):
         self.assertEqual(len(hub.devices), 9)
 
     @patch("getmac.get_mac_address", new=fake_get_mac_address)
-    @patch("aiohttp.request", new=create_fake_request())
+    @patch("aiohttp.ClientSession", new=create_fake_session())
+    def test_load_devices_concurrency(self) -> None:
+        """Device loading should respect the concurrent request limit."""
+        hub = Hub("1.2.3.4", "1234", "token", max_concurrent_requests=2)
+
+        active = 0
+        max_active = 0
+        loaded: List[str] = []
+
+        async def fake_load_device(
+            self: Hub, device_id: str, force_refresh=False
+        ) -> None:
+            nonlocal active, max_active
+            active += 1
+            max_active = max(active, max_active)
+            await asyncio.sleep(0)
+            loaded.append(device_id)
+            active -= 1
+
+        with patch.object(Hub, "_load_device", new=fake_load_device):
+            wait_for(hub.load_devices())
+
+        self.assertEqual(len(loaded), len(devices))
+        self.assertEqual(max_active, 2)
+
+    @patch("getmac.get_mac_address", new=fake_get_mac_address)
+    @patch("aiohttp.ClientSession", new=create_fake_session())
+    def test_load_devices_skips_cached(self) -> None:
+        """Device loading should only request devices that aren't loaded."""
+        hub = Hub("1.2.3.4", "1234", "token")
+        wait_for(hub.refresh_device("176"))
+        request_count = len(requests)
+        wait_for(hub.load_devices())
+        self.assertEqual(len(requests), request_count)
+
+        wait_for(hub.load_devices(force_refresh=True))
+        device_requests = [r for r in requests if r["url"].endswith("/devices/176")]
+        self.assertEqual(len(device_requests), 2)
+        self.assertEqual(len(hub.devices), 9)
+
+    @patch("getmac.get_mac_address", new=fake_get_mac_address)
+    @patch(
+        "aiohttp.ClientSession",
+        new=create_fake_session(
+            {
+                "/devices": FakeResponse(
+                    data="<html></html>", url="/devices", content_type="text/html"
+                )
+            }
+        ),
+    )
+    def test_check_config_non_json_response(self) -> None:
+        """A non-JSON response should raise a ConnectionError, with or without
+        ijson."""
+        hub = Hub("1.2.3.4", "1234", "token")
+        self.assertRaises(ConnectionError, wait_for, hub.check_config())
+        with patch("hubitatmaker.hub.ijson", new=None):
+            self.assertRaises(ConnectionError, wait_for, hub.check_config())
+
+    @patch("getmac.get_mac_address", new=fake_get_mac_address)
+    @patch(
+        "aiohttp.ClientSession",
+        new=create_fake_session(
+            {
+                "/devices": FakeResponse(
+                    data={"error": True, "type": "AccessDenied"}, url="/devices"
+                )
+            }
+        ),
+    )
+    def test_check_config_error_response(self) -> None:
+        """An error response should raise a RequestError, with or without
+        ijson."""
+        hub = Hub("1.2.3.4", "1234", "token")
+        self.assertRaises(RequestError, wait_for, hub.check_config())
+        with patch("hubitatmaker.hub.ijson", new=None):
+            self.assertRaises(RequestError, wait_for, hub.check_config())
+
+    @patch("getmac.get_mac_address", new=fake_get_mac_address)
+    @patch("aiohttp.ClientSession", new=create_fake_session())
+    @patch("hubitatmaker.hub.ijson", new=None)
+    @patch("hubitatmaker.server.Server")
+    def test_devices_loaded_without_ijson(self, MockServer) -> None:
+        """Hub should load the device list without ijson."""
+        hub = Hub("1.2.3.4", "1234", "token")
+        wait_for(hub.start())
+        self.assertEqual(len(hub.devices), 9)
+
+    @patch("getmac.get_mac_address", new=fake_get_mac_address)
+    @patch("aiohttp.ClientSession", new=create_fake_session())
+    @patch("hubitatmaker.hub.orjson", new=None)
+    @patch("hubitatmaker.server.Server")
+    def test_devices_loaded_without_orjson(self, MockServer) -> None:
+        """Hub should decode responses without orjson."""
+        hub = Hub("1.2.3.4", "1234", "token")
+        wait_for(hub.start())
+        self.assertEqual(len(hub.devices), 9)
+
+    @patch("getmac.get_mac_address", new=fake_get_mac_address)
+    @patch("aiohttp.ClientSession", new=create_fake_session())
     @patch("hubitatmaker.server.Server")
     def test_process_event(self, MockServer) -> None:
         """Started hub should process a device event."""
@@ -316,7 +571,79 @@ class TestHub(TestCase):
         self.assertEqual(attr.value, "on")
 
     @patch("getmac.get_mac_address", new=fake_get_mac_address)
-    @patch("aiohttp.request", new=create_fake_request())
+    @patch("aiohttp.ClientSession", new=create_fake_session())
+    @patch("hubitatmaker.server.Server")
+    def test_process_device_event(self, MockServer) -> None:
+        """Started hub should emit device events to device listeners."""
+        hub = Hub("1.2.3.4", "1234", "token")
+        wait_for(hub.start())
+
+        calls: List[Any] = []
+        on_event = events["device"]
+        off_event = {"content": {**on_event["content"], "value": "off"}}
+
+        hub._process_event(on_event)
+        self.assertEqual(len(calls), 0)
+
+        hub.add_device_listener("176", calls.append)
+        hub.add_device_listener("176", calls.append)
+        hub._process_event(off_event)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[0].value, "off")
+
+        # An event that doesn't change the device's state shouldn't be emitted
+        hub._process_event(off_event)
+        self.assertEqual(len(calls), 2)
+
+        hub.remove_device_listeners("176")
+        hub._process_event(on_event)
+        self.assertEqual(len(calls), 2)
+
+    @patch("getmac.get_mac_address", new=fake_get_mac_address)
+    @patch("aiohttp.ClientSession", new=create_fake_session())
+    @patch("hubitatmaker.server.Server")
+    def test_process_repeated_button_event(self, MockServer) -> None:
+        """Repeated button events should always be emitted."""
+        device_details["176"]["attributes"].extend(
+            [
+                {"name": "pushed", "dataType": "NUMBER", "currentValue": "1"},
+                {"name": "released", "dataType": "NUMBER", "currentValue": "1"},
+            ]
+        )
+        hub = Hub("1.2.3.4", "1234", "token")
+        wait_for(hub.start())
+
+        calls: List[Any] = []
+        hub.add_device_listener("176", calls.append)
+
+        for name in ("pushed", "released"):
+            event = {
+                "content": {**events["device"]["content"], "name": name, "value": "1"}
+            }
+            hub._process_event(event)
+            hub._process_event(event)
+        self.assertEqual(len(calls), 4)
+
+    @patch("getmac.get_mac_address", new=fake_get_mac_address)
+    @patch("aiohttp.ClientSession", new=create_fake_session())
+    @patch("hubitatmaker.server.Server")
+    def test_process_unchanged_numeric_event(self, MockServer) -> None:
+        """An event repeating a numeric value as a string shouldn't be emitted."""
+        hub = Hub("1.2.3.4", "1234", "token")
+        wait_for(hub.start())
+
+        calls: List[Any] = []
+        hub.add_device_listener("176", calls.append)
+
+        # power is loaded as the number 0; events report values as strings
+        event = {
+            "content": {**events["device"]["content"], "name": "power", "value": "0"}
+        }
+        hub._process_event(event)
+        self.assertEqual(len(calls), 0)
+
+    @patch("getmac.get_mac_address", new=fake_get_mac_address)
+    @patch("aiohttp.ClientSession", new=create_fake_session())
     @patch("hubitatmaker.server.Server")
     def test_process_mode_event(self, MockServer) -> None:
         """Started hub should emit mode events."""
@@ -337,7 +664,7 @@ class TestHub(TestCase):
         self.assertTrue(handler_called)
 
     @patch("getmac.get_mac_address", new=fake_get_mac_address)
-    @patch("aiohttp.request", new=create_fake_request())
+    @patch("aiohttp.ClientSession", new=create_fake_session())
     @patch("hubitatmaker.server.Server")
     def test_process_hsm_event(self, MockServer) -> None:
         """Started hub should emit HSM events."""
@@ -358,7 +685,7 @@ class TestHub(TestCase):
         self.assertTrue(handler_called)
 
     @patch("getmac.get_mac_address", new=fake_get_mac_address)
-    @patch("aiohttp.request", new=create_fake_request())
+    @patch("aiohttp.ClientSession", new=create_fake_session())
     @patch("hubitatmaker.server.Server")
     def test_process_other_event(self, MockServer) -> None:
         """Started hub should ignore non-device, non-mode events."""
@@ -374,7 +701,7 @@ class TestHub(TestCase):
         self.assertEqual(attr.value, "off")
 
     @patch("getmac.get_mac_address", new=fake_get_mac_address)
-    @patch("aiohttp.request", new=create_fake_request())
+    @patch("aiohttp.ClientSession", new=create_fake_session())
     @patch("hubitatmaker.server.Server")
     def test_process_set_hsm(self, MockServer) -> None:
         """Started hub should allow mode to be updated."""
@@ -388,7 +715,7 @@ class TestHub(TestCase):
         self.assertEqual(hub.hsm_status, "armedAway")
 
     @patch("getmac.get_mac_address", new=fake_get_mac_address)
-    @patch("aiohttp.request", new=create_fake_request())
+    @patch("aiohttp.ClientSession", new=create_fake_session())
     @patch("hubitatmaker.server.Server")
     def test_process_set_mode(self, MockServer) -> None:
         """Started hub should allow mode to be updated."""
@@ -402,7 +729,7 @@ class TestHub(TestCase):
         self.assertEqual(hub.mode, "Evening")
 
     @patch("getmac.get_mac_address", new=fake_get_mac_address)
-    @patch("aiohttp.request", new=create_fake_request())
+    @patch("aiohttp.ClientSession", new=create_fake_session())
     @patch("hubitatmaker.server.Server")
     def test_set_event_url(self, MockServer) -> None:
         """Started hub should allow mode to be updated."""
@@ -411,10 +738,14 @@ class TestHub(TestCase):
         hub = Hub("1.2.3.4", "1234", "token")
         wait_for(hub.start())
 
-        wait_for(hub.set_event_url(None))
-        event_url = unquote(requests[-1]["url"])
+        event_url = unquote(requests[0]["url"])
         self.assertRegex(event_url, f"postURL/{server_url}$")
 
+        # Setting the URL the hub already has shouldn't make a request
+        request_count = len(requests)
+        wait_for(hub.set_event_url(None))
+        self.assertEqual(len(requests), request_count)
+
         other_url = "http://10.0.1.1:4443"
         wait_for(hub.set_event_url(other_url))
         event_url = unquote(requests[-1]["url"])
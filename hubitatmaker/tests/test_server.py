@@ -0,0 +1,71 @@
+import asyncio
+from typing import Any, Dict, List
+from unittest import TestCase
+from unittest.mock import patch
+
+from hubitatmaker.server import Server
+
+
+class FakeRequest:
+    def __init__(self, data: Dict[str, Any]):
+        self._data = data
+
+    async def json(self):
+        return self._data
+
+
+class TestServer(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+    def test_events_delivered_in_batches(self) -> None:
+        """A burst of events should be delivered in one app loop callback."""
+        received: List[Dict[str, Any]] = []
+        server = Server(received.append, "127.0.0.1", 0)
+
+        async def post_events():
+            with patch.object(
+                self.loop, "call_soon_threadsafe", wraps=self.loop.call_soon_threadsafe
+            ) as call_soon:
+                for i in range(3):
+                    await server._handle_request(FakeRequest({"id": i}))
+                self.assertEqual(call_soon.call_count, 1)
+            self.assertEqual(received, [])
+            await asyncio.sleep(0)
+
+        self.loop.run_until_complete(post_events())
+        self.assertEqual(received, [{"id": 0}, {"id": 1}, {"id": 2}])
+
+        # A later event should schedule a new flush
+        self.loop.run_until_complete(server._handle_request(FakeRequest({"id": 3})))
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(received[-1], {"id": 3})
+
+    def test_event_error_does_not_drop_batch(self) -> None:
+        """An event handler error shouldn't prevent later events in a batch
+        from being delivered."""
+        received: List[Dict[str, Any]] = []
+        errors: List[Dict[str, Any]] = []
+
+        def handle_event(event: Dict[str, Any]) -> None:
+            if event["id"] == 1:
+                raise KeyError("deviceId")
+            received.append(event)
+
+        self.loop.set_exception_handler(lambda loop, context: errors.append(context))
+        server = Server(handle_event, "127.0.0.1", 0)
+
+        async def post_events():
+            for i in range(4):
+                await server._handle_request(FakeRequest({"id": i}))
+            await asyncio.sleep(0)
+
+        self.loop.run_until_complete(post_events())
+        self.assertEqual(received, [{"id": 0}, {"id": 2}, {"id": 3}])
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0]["event"], {"id": 1})
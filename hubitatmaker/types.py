@@ -1,3 +1,4 @@
+import sys
 from types import MappingProxyType
 from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple, Union
 
@@ -69,7 +70,9 @@ class Device:
         self._attributes: Dict[str, Attribute] = {}
         self._attributes_ro = MappingProxyType(self._attributes)
         for attr in properties.get("attributes", []):
-            self._attributes[attr["name"]] = Attribute(attr)
+            # Attribute names come from a small, repeated set, so intern them
+            # to make event lookups hit on identity
+            self._attributes[sys.intern(attr["name"])] = Attribute(attr)
 
         caps: List[str] = [
             p for p in properties.get("capabilities", []) if isinstance(p, str)